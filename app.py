@@ -1,13 +1,20 @@
 import os
+import re
 import subprocess
-import json
-import uuid
+import base64
+import secrets
 import time
 import logging
 import io
+import shutil
+import queue
+import selectors
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+from cachetools import TTLCache
 from PIL import Image, UnidentifiedImageError
-from flask import Flask, render_template, request, jsonify, Response
-from apscheduler.schedulers.background import BackgroundScheduler
+from flask import Flask, render_template, request, jsonify, Response, after_this_request
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
 
@@ -36,55 +43,345 @@ ALLOWED_EXTENSIONS = {
 }
 
 # 定义通用/Web优化图片格式（无需转换）
-SUPPORTED_WEB_FORMATS = {'JPEG', 'JPG', 'PNG', 'GIF', 'WebP', 'AVIF', 'SVG', 'BMP', 'ICO'}
+SUPPORTED_WEB_FORMATS = {'JPEG', 'JPG', 'PNG', 'GIF', 'WEBP', 'AVIF', 'SVG', 'BMP', 'ICO'}
 
 # EXIF截断配置
 MAX_LENGTH = 200
 TRUNCATED_LENGTH = 40
 ELLIPSIS = "......"
 
+# exiftool 对二进制标签输出的占位值："(Binary data 12345 bytes, use -b option to extract)"
+BINARY_DATA_RE = re.compile(r'\(Binary data (\d+) bytes')
+
+# URL 中允许的标签名（如 JpgFromRaw、EXIF:PreviewImage，需 fullmatch），防止参数注入 exiftool
+TAG_NAME_RE = re.compile(r'[A-Za-z0-9][A-Za-z0-9_:-]*')
+
+# 预览图重新编码的JPEG质量（仅非JPEG原图需要重新编码）
+JPEG_QUALITY = 90
+# WebP编码质量（method=0 为最快的编码速度，预览足够）
+WEBP_QUALITY = 85
+
+# 输出格式对应的 MIME 类型与扩展名
+OUTPUT_FORMATS = {
+    'JPEG': ('image/jpeg', 'jpg'),
+    'WEBP': ('image/webp', 'webp'),
+}
+
+# 上传文件写入块大小（1MB）
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# exiftool 常驻进程数量（并发请求之间不必串行等待）
+EXIFTOOL_POOL_SIZE = 4
+# 单条 exiftool 命令的最长等待时间（秒），超时则杀掉并重启该常驻进程
+EXIFTOOL_TIMEOUT = 60
+
+# 解析结果缓存（TTL与10分钟清理策略一致）
+CACHE_MAXSIZE = 256
+# 预览图缓存含转换后的图片数据，按字节数限制容量（640MB）
+PREVIEW_CACHE_MAXBYTES = 640 * 1024 * 1024
+CACHE_TTL = 600
+
+# 上传接口最多返回的预览图数量（仅转换最大的几个）
+MAX_PREVIEWS = 5
+
+# 上传时与EXIF提取并行预取的常见预览图标签
+PREVIEW_CANDIDATE_TAGS = ['JpgFromRaw', 'PreviewImage', 'ThumbnailImage', 'PreviewTIFF']
+
+# 后台任务线程池（EXIF提取、预览图转换；限制并发的exiftool/PIL任务数）
+executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+def json_response(payload, status=200):
+    """使用 orjson 序列化JSON响应（体积较大的EXIF数据比 jsonify 快得多）"""
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
+
 def allowed_file(filename):
     """校验文件格式是否允许"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def save_upload(file, filepath):
+    """以1MB块流式写入上传文件，并提示内核预读（随后exiftool会多次读取该文件）"""
+    with open(filepath, 'wb', buffering=UPLOAD_CHUNK_SIZE) as out:
+        shutil.copyfileobj(file.stream, out, UPLOAD_CHUNK_SIZE)
+        out.flush()
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(out.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+def drop_page_cache(filepath):
+    """释放文件占用的页缓存（响应发送完成后调用）"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logging.warning(f"释放页缓存失败: {e}")
+
+# ========== 按文件缓存解析结果 ==========
+# 键为 (文件路径, 修改时间ns)，TTLCache 非线程安全，统一由 cache_lock 保护
+exif_cache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL)
+cache_lock = threading.Lock()
+
+def preview_cache_size(value):
+    """预览缓存条目的大小：所含转换后图片数据（JPEG及按需生成的WebP）的总字节数（至少计1）"""
+    _, valid_preview_tags = value
+    return max(1, sum(
+        len(meta["converted_bytes"]) + len(meta.get("converted_bytes_webp") or b"")
+        for meta in valid_preview_tags.values()
+    ))
+
+preview_cache = TTLCache(maxsize=PREVIEW_CACHE_MAXBYTES, ttl=CACHE_TTL, getsizeof=preview_cache_size)
+
+def get_file_cache(cache, filepath):
+    """读取文件对应的缓存（未命中返回None）"""
+    key = (filepath, os.stat(filepath).st_mtime_ns)
+    with cache_lock:
+        return cache.get(key)
+
+def put_file_cache(cache, filepath, value):
+    """写入（或更新）文件对应的缓存，条目大小会重新计算"""
+    key = (filepath, os.stat(filepath).st_mtime_ns)
+    with cache_lock:
+        try:
+            cache[key] = value
+        except ValueError:
+            # 单个条目超过缓存容量，不缓存
+            logging.warning(f"缓存条目过大，跳过缓存: {filepath}")
+
+def cached_by_file(cache, filepath, compute):
+    """按 (文件路径, 修改时间) 缓存 compute() 的结果（空结果不缓存）"""
+    value = get_file_cache(cache, filepath)
+    if value is None:
+        value = compute()
+        if value:
+            put_file_cache(cache, filepath, value)
+    return value
+
+def invalidate_file_cache(filepath):
+    """删除文件相关的所有缓存"""
+    with cache_lock:
+        for cache in (exif_cache, preview_cache):
+            for key in [k for k in cache.keys() if k[0] == filepath]:
+                cache.pop(key, None)
+
 def clean_old_files():
     """自动清理超过10分钟的文件"""
     try:
         now = time.time()
         cutoff = now - 600  # 10分钟
-        files_removed = 0
+        removed = []
         
-        for f in os.listdir(UPLOAD_FOLDER):
-            f_path = os.path.join(UPLOAD_FOLDER, f)
-            if os.path.isfile(f_path) and os.stat(f_path).st_mtime < cutoff:
-                os.remove(f_path)
-                files_removed += 1
-                logging.info(f"清理过期文件: {f}")
+        # os.scandir 返回的 DirEntry 自带文件类型信息，每个文件只需一次 stat
+        with os.scandir(UPLOAD_FOLDER) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    invalidate_file_cache(entry.path)
+                    removed.append(entry.name)
         
-        if files_removed > 0:
-            logging.info(f"共清理 {files_removed} 个过期文件")
+        if removed:
+            logging.info(f"共清理 {len(removed)} 个过期文件: {', '.join(removed)}")
     except Exception as e:
         logging.error(f"清理文件失败: {e}")
 
-# 启动定时任务
-scheduler = BackgroundScheduler()
-# scheduler.add_job(func=clean_old_files, trigger="interval", seconds=300)  # 每5分钟清理一次
-scheduler.start()
+# 启动定时任务（单个后台线程，每5分钟清理一次）
+CLEAN_INTERVAL = 300
+cleanup_stop = threading.Event()
+
+def _cleanup_loop():
+    while not cleanup_stop.wait(CLEAN_INTERVAL):
+        clean_old_files()
+
+threading.Thread(target=_cleanup_loop, name="clean-old-files", daemon=True).start()
+
+# ========== exiftool 常驻进程（-stay_open） ==========
+class ExifToolError(Exception):
+    """exiftool 执行失败（stderr 中出现 Error）"""
+    def __init__(self, stderr):
+        super().__init__(stderr)
+        self.stderr = stderr
+
+class ExifToolDaemon:
+    """
+    常驻的 exiftool 进程（exiftool -stay_open True -@ -）
+    参数逐行写入 stdin，以 -executeN 结束一条命令，stdout/stderr 同时读取到 {readyN} 标记为止，
+    避免每次调用都重新启动 Perl 解释器并加载模块
+    """
+    def __init__(self, executable='exiftool'):
+        self.executable = executable
+        self._proc = None
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _start(self):
+        self._proc = subprocess.Popen(
+            [self.executable, '-stay_open', 'True', '-@', '-'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        logging.info(f"exiftool 常驻进程已启动（PID：{self._proc.pid}）")
+
+    def _read_response(self, ready, timeout):
+        """
+        同时读取 stdout/stderr，直到两者都出现 ready 标记，返回 (stdout, stderr)
+        两个管道并发读取，避免一方写满管道缓冲区（约64KB）后与另一方互相阻塞；
+        超过 timeout 秒仍未完成则抛出 ExifToolError
+        就地去掉标记后直接返回 bytearray（bytes-like，PIL/BytesIO/Response 均可直接使用），
+        避免为数MB的预览图再整体复制一次
+        """
+        deadline = time.monotonic() + timeout
+        stdout_fd, stderr_fd = self._proc.stdout.fileno(), self._proc.stderr.fileno()
+        buffers = {stdout_fd: bytearray(), stderr_fd: bytearray()}
+        tail_size = len(ready) + 2
+        
+        with selectors.DefaultSelector() as selector:
+            for fd in buffers:
+                selector.register(fd, selectors.EVENT_READ)
+            pending = len(buffers)
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ExifToolError(f"exiftool 响应超时（{timeout}秒）")
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fd, 1 << 16)
+                    if not chunk:
+                        raise ExifToolError("exiftool 常驻进程意外退出")
+                    buf = buffers[key.fd]
+                    buf += chunk
+                    if bytes(buf[-tail_size:]).rstrip(b"\r\n").endswith(ready):
+                        del buf[buf.rfind(ready):]
+                        selector.unregister(key.fd)
+                        pending -= 1
+        return buffers[stdout_fd], buffers[stderr_fd]
+
+    def execute(self, *args):
+        """
+        执行一条 exiftool 命令
+        :param args: 命令参数（str 或 bytes）
+        :return: stdout 二进制数据（bytearray）
+        """
+        lines = [a if isinstance(a, bytes) else str(a).encode('utf-8') for a in args]
+        # 参数经 -@ 逐行传递，含换行的参数会被拆成额外的 exiftool 选项
+        if any(b"\n" in line or b"\r" in line for line in lines):
+            raise ExifToolError("exiftool 参数中不允许包含换行符")
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._start()
+            self._seq += 1
+            ready = f"{{ready{self._seq}}}".encode()
+            lines += [b"-echo4", ready, f"-execute{self._seq}".encode()]
+            try:
+                self._proc.stdin.write(b"\n".join(lines) + b"\n")
+                self._proc.stdin.flush()
+                stdout, stderr = self._read_response(ready, EXIFTOOL_TIMEOUT)
+                stderr = stderr.decode('utf-8', errors='ignore')
+            except (OSError, ExifToolError):
+                # 进程已损坏或无响应，杀掉后下次调用时重新启动
+                self._proc.kill()
+                self._proc.wait()
+                self._proc = None
+                raise
+        if any(line.startswith("Error") for line in stderr.splitlines()):
+            raise ExifToolError(stderr.strip())
+        return stdout
+
+    def close(self):
+        """通知 exiftool 退出常驻模式"""
+        with self._lock:
+            if self._proc is None:
+                return
+            try:
+                if self._proc.poll() is None:
+                    self._proc.stdin.write(b"-stay_open\nFalse\n")
+                    self._proc.stdin.flush()
+                    self._proc.wait(timeout=5)
+            except Exception:
+                self._proc.kill()
+            self._proc = None
+
+class ExifToolPool:
+    """多个 exiftool 常驻进程组成的池（进程在首次使用时启动）"""
+    def __init__(self, size):
+        self._daemons = [ExifToolDaemon() for _ in range(size)]
+        self._idle = queue.Queue()
+        for daemon in self._daemons:
+            self._idle.put(daemon)
+
+    def execute(self, *args):
+        daemon = self._idle.get()
+        try:
+            return daemon.execute(*args)
+        finally:
+            self._idle.put(daemon)
+
+    def close(self):
+        for daemon in self._daemons:
+            daemon.close()
+
+exiftool_pool = ExifToolPool(EXIFTOOL_POOL_SIZE)
 
 # ========== EXIF信息截断 ==========
-def truncate_long_values(data):
-    """递归遍历数据结构，截断过长的字符串值"""
-    if isinstance(data, dict):
-        for key, value in data.items():
-            data[key] = truncate_long_values(value)
-    elif isinstance(data, list):
-        for i, item in enumerate(data):
-            data[i] = truncate_long_values(item)
-    elif isinstance(data, str):
-        if len(data) > MAX_LENGTH:
-            data = data[:TRUNCATED_LENGTH] + ELLIPSIS
+def truncate_long_values(data, _max=MAX_LENGTH, _keep=TRUNCATED_LENGTH, _ellipsis=ELLIPSIS,
+                         _type=type, _len=len, _str=str, _dict=dict, _list=list, _enumerate=enumerate):
+    """
+    遍历数据结构（显式栈迭代，无递归调用），原地截断过长的字符串值
+    下划线参数仅用于把热点循环中的全局名/内置名绑定为局部变量，调用时不要传入
+    """
+    if _type(data) is _str:
+        return data if _len(data) <= _max else data[:_keep] + _ellipsis
+    
+    stack = [data]
+    pop, push = stack.pop, stack.append
+    while stack:
+        node = pop()
+        node_type = _type(node)
+        if node_type is _dict:
+            items = node.items()
+        elif node_type is _list:
+            items = _enumerate(node)
+        else:
+            continue
+        for key, value in items:
+            value_type = _type(value)
+            if value_type is _str:
+                if _len(value) > _max:
+                    node[key] = value[:_keep] + _ellipsis
+            elif value_type is _dict or value_type is _list:
+                push(value)
     return data
 
+# ========== 一次调用提取多个二进制标签 ==========
+def extract_binary_tags(filepath, tags):
+    """
+    通过一次exiftool调用（-j -b，二进制以base64输出）提取多个二进制标签
+    :param filepath: RAW文件路径
+    :param tags: 标签名列表
+    :return: {标签名: 二进制数据}（不存在的标签不包含在内）
+    """
+    result = exiftool_pool.execute("-j", "-b", *[f"-{tag}" for tag in tags], filepath)
+    items = orjson.loads(result)[0] if result else {}
+    
+    blobs = {}
+    for tag in tags:
+        value = items.get(tag)
+        if not isinstance(value, str):
+            continue
+        blobs[tag] = base64.b64decode(value[7:]) if value.startswith("base64:") else value.encode('utf-8')
+    return blobs
+
+def extract_preview_blobs(filepath, tags):
+    """批量提取二进制标签，失败时记录日志并返回空字典"""
+    try:
+        return extract_binary_tags(filepath, tags)
+    except ExifToolError as e:
+        logging.warning(f"批量提取二进制标签失败：{e.stderr}")
+    except ValueError as e:
+        logging.warning(f"批量提取二进制标签解析失败：{e}")
+    return {}
+
 # ========== 优先提取最大预览图（JpgFromRaw → PreviewImage） ==========
 def extract_preview_data(filepath, tag_name=None):
     """
@@ -96,150 +393,242 @@ def extract_preview_data(filepath, tag_name=None):
     # 优先尝试的标签列表
     priority_tags = ['JpgFromRaw', 'PreviewImage'] if tag_name is None else [tag_name]
     
+    try:
+        if tag_name is None:
+            # 所有候选标签一次提取，按优先级取第一个有效结果
+            blobs = extract_binary_tags(filepath, priority_tags)
+        else:
+            blobs = {tag_name: exiftool_pool.execute("-b", f"-{tag_name}", filepath)}
+    except ExifToolError as e:
+        logging.warning(f"标签 {', '.join(priority_tags)} 提取失败：{e.stderr}")
+        return False, None, None
+    except ValueError as e:
+        logging.warning(f"标签 {', '.join(priority_tags)} 解析失败：{e}")
+        return False, None, None
+    
     for tag in priority_tags:
-        try:
-            cmd = ["exiftool", "-b", f"-{tag}", filepath]
-            result = subprocess.run(
-                cmd, 
-                check=True, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE
-            )
-            preview_data = result.stdout
-            # 验证数据有效性（至少100字节）
-            if preview_data and len(preview_data) > 100:
-                logging.info(f"成功提取预览图（标签：{tag}），大小：{len(preview_data)/1024:.2f} KB")
-                return True, preview_data, tag
-            logging.warning(f"标签 {tag} 提取的数据无效（空或过小）")
-        except subprocess.CalledProcessError as e:
-            logging.warning(f"标签 {tag} 提取失败：{e.stderr.decode('utf-8', errors='ignore')}")
-            continue
+        preview_data = blobs.get(tag)
+        # 验证数据有效性（至少100字节）
+        if preview_data and len(preview_data) > 100:
+            logging.info(f"成功提取预览图（标签：{tag}），大小：{len(preview_data)/1024:.2f} KB")
+            return True, preview_data, tag
+        logging.warning(f"标签 {tag} 提取的数据无效（空或过小）")
     
     return False, None, None
 
 # ========== 复制原始EXIF到预览文件 ==========
-def copy_exif_to_preview(source_raw_path, target_preview_path):
+def copy_exif_to_preview(source_raw_path, preview_path):
     """
-    将原始RAW文件的EXIF元数据复制到预览文件
+    将原始RAW文件的EXIF元数据合并到预览文件，结果经 stdout 直接返回（-o -），
+    不改写预览文件、也无需再读回
     :param source_raw_path: 原始RAW文件路径
-    :param target_preview_path: 预览文件路径
-    :return: 是否成功
+    :param preview_path: 预览文件路径
+    :return: 带EXIF的预览图二进制数据（失败返回None）
     """
     try:
-        cmd = [
-            'exiftool',
+        result = exiftool_pool.execute(
+            '-q',
             '-tagsfromfile', source_raw_path,
             '-all:all',
             '-unsafe',
-            '-overwrite_original',
-            target_preview_path
-        ]
-        result = subprocess.run(
-            cmd,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='utf-8'
+            '-o', '-',
+            preview_path
         )
-        logging.info(f"EXIF元数据复制成功：{result.stdout.strip()}")
-        return True
-    except subprocess.CalledProcessError as e:
-        logging.error(f"EXIF复制失败：{e.stderr.strip()}")
-        return False
+        if not result:
+            logging.error("EXIF复制失败：exiftool 未输出数据")
+            return None
+        logging.info(f"EXIF元数据复制成功：{len(result)/1024:.2f} KB")
+        return result
+    except ExifToolError as e:
+        logging.error(f"EXIF复制失败：{e.stderr}")
+        return None
     except Exception as e:
         logging.error(f"EXIF复制异常：{str(e)}")
-        return False
+        return None
 
 # ========== 检测图片原始格式 ==========
 def get_image_original_format(binary_data):
-    """获取图片原始格式"""
+    """获取图片原始格式（优先通过文件头魔数识别，无需PIL解析）"""
+    head = bytes(binary_data[:12])
+    if head[:2] == b'\xff\xd8':
+        return "JPEG"
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return "PNG"
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return "WEBP"
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return "TIFF"
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return "GIF"
+    if head[:2] == b'BM':
+        return "BMP"
+    
+    # 其他格式交由PIL识别（Image.open 只读取文件头，不解码像素）
     try:
         with Image.open(io.BytesIO(binary_data)) as img:
             return img.format.upper() if img.format else "UNKNOWN"
     except Exception:
         return "UNKNOWN"
 
+# ========== 读取JPEG宽高（不解码） ==========
+def get_jpeg_size(binary_data):
+    """
+    遍历JPEG标记段，从SOF段读取宽高，不解码图像
+    :param binary_data: 图片二进制数据
+    :return: (宽度, 高度)，非JPEG、非浏览器可解码的JPEG（仅支持SOF0~SOF2）或解析失败返回None
+    """
+    if binary_data[:2] != b'\xff\xd8':
+        return None
+    
+    pos, length = 2, len(binary_data)
+    while pos + 4 <= length:
+        if binary_data[pos] != 0xFF:
+            return None
+        marker = binary_data[pos + 1]
+        # 填充字节
+        if marker == 0xFF:
+            pos += 1
+            continue
+        # 无长度字段的独立标记（TEM、RST0~RST7）
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+        # 在SOF之前遇到SOS/EOI，视为无效
+        if marker in (0xD9, 0xDA):
+            return None
+        # 无损/分层/算术编码（SOF3、SOF5~SOF15，排除DHT、JPG、DAC）浏览器无法解码，不可直通
+        if 0xC3 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return None
+        # SOF0~SOF2（基线、扩展顺序、渐进式）：长度(2) + 精度(1) + 高度(2) + 宽度(2)
+        if 0xC0 <= marker <= 0xC2:
+            if pos + 9 > length:
+                return None
+            height = int.from_bytes(binary_data[pos + 5:pos + 7], 'big')
+            width = int.from_bytes(binary_data[pos + 7:pos + 9], 'big')
+            return (width, height) if width and height else None
+        pos += 2 + int.from_bytes(binary_data[pos + 2:pos + 4], 'big')
+    return None
+
 # ========== 图片格式转换（非通用格式转JPG/WebP）【核心修改】 ==========
-def convert_image_to_web_format(binary_data, target_format='JPEG', temp_file_prefix=None):
+def convert_image_to_web_format(binary_data, target_format='JPEG', temp_file_prefix=None, progressive=False):
     """
     将非通用格式图片转换为Web兼容格式，并保留EXIF
     【修复】强制为所有预览图生成临时文件并复制EXIF，无论原始格式是否为通用格式
+    【优化】原始数据已是JPEG且目标为JPEG时直接使用原始数据，不经PIL解码/重新编码
     :param binary_data: 原始二进制数据
-    :param target_format: 目标格式（JPEG/WebP）
+    :param target_format: 目标格式（JPEG/WEBP）
     :param temp_file_prefix: 临时文件前缀（用于复制EXIF）
+    :param progressive: 是否编码为渐进式JPEG（编码较慢，仅在客户端请求时使用；JPEG直通时不重新编码，忽略此参数）
     :return: (是否转换成功, 转换后二进制数据, 宽度, 高度, 原始格式)
     """
-    # 先检测原始格式
-    original_format = get_image_original_format(binary_data)
-    logging.info(f"原始图片格式: {original_format}")
+    jpeg_size = get_jpeg_size(binary_data) if target_format == 'JPEG' else None
+    if jpeg_size:
+        # JPEG直通：仅需合并EXIF
+        original_format = "JPEG"
+        logging.info("原始图片格式: JPEG（直通，跳过重新编码）")
+        converted_data = binary_data
+        width, height = jpeg_size
+    else:
+        # 先检测原始格式
+        original_format = get_image_original_format(binary_data)
+        logging.info(f"原始图片格式: {original_format}")
+        
+        try:
+            with Image.open(io.BytesIO(binary_data)) as img:
+                output = io.BytesIO()
+                if target_format == 'WEBP':
+                    # WebP支持透明通道，其余模式统一转为RGB
+                    if img.mode not in ('RGB', 'RGBA'):
+                        img = img.convert('RGBA' if img.mode in ('P', 'LA', 'PA') else 'RGB')
+                    img.save(output, format='WEBP', quality=WEBP_QUALITY, method=0)
+                else:
+                    # 处理透明通道（JPEG不支持透明）
+                    if img.mode in ('RGBA', 'P', 'L'):
+                        img = img.convert('RGB')
+                    # 保存为目标格式（无论是否通用格式）
+                    img.save(output, format=target_format, quality=JPEG_QUALITY, optimize=False, progressive=progressive)
+                converted_data = output.getvalue()
+                width, height = img.width, img.height
+        except (UnidentifiedImageError, IOError, SyntaxError) as e:
+            logging.error(f"图片转换失败: {e}")
+            return False, None, 0, 0, original_format
     
-    # 生成唯一临时文件名（避免冲突）
-    temp_file = None
-    if temp_file_prefix:
-        temp_file = f"{temp_file_prefix}_temp_{uuid.uuid4().hex[:8]}.jpg"
+    if not temp_file_prefix:
+        # 无临时文件前缀时直接返回转换后数据（无EXIF）
+        return True, converted_data, width, height, original_format
     
+    # 生成唯一临时文件名（避免冲突）
+    temp_ext = OUTPUT_FORMATS.get(target_format, OUTPUT_FORMATS['JPEG'])[1]
+    temp_file = f"{temp_file_prefix}_temp_{secrets.token_hex(4)}.{temp_ext}"
     try:
-        with Image.open(io.BytesIO(binary_data)) as img:
-            # 处理透明通道（JPEG不支持透明）
-            if img.mode in ('RGBA', 'P', 'L'):
-                img = img.convert('RGB')
-            
-            # 保存为目标格式到临时文件（无论是否通用格式）
-            if temp_file:
-                img.save(temp_file, format=target_format, quality=95)
-                # 强制复制EXIF到临时文件
-                copy_exif_to_preview(temp_file_prefix, temp_file)
-                # 读取带EXIF的文件数据
-                with open(temp_file, 'rb') as f:
-                    converted_data = f.read()
-            else:
-                # 无临时文件前缀时直接返回转换后数据（无EXIF）
-                output = io.BytesIO()
-                img.save(output, format=target_format, quality=95)
-                converted_data = output.getvalue()
-            
-            return True, converted_data, img.width, img.height, original_format
-    except (UnidentifiedImageError, IOError, SyntaxError) as e:
+        # 写入临时文件供exiftool读取，带EXIF的数据经stdout返回（复制失败则保留无EXIF数据）
+        with open(temp_file, 'wb') as f:
+            f.write(converted_data)
+        converted_data = copy_exif_to_preview(temp_file_prefix, temp_file) or converted_data
+        return True, converted_data, width, height, original_format
+    except IOError as e:
         logging.error(f"图片转换失败: {e}")
         return False, None, 0, 0, original_format
     finally:
         # 确保临时文件被清理
-        if temp_file and os.path.exists(temp_file):
+        if os.path.exists(temp_file):
             try:
                 os.remove(temp_file)
                 logging.info(f"清理临时文件: {temp_file}")
             except Exception as e:
                 logging.warning(f"清理临时文件失败: {e}")
 
-# ========== 核心函数：自动识别所有预览图二进制块 ==========
-def get_preview_tags(raw_exif, filepath):
-    """自动识别所有预览图二进制块"""
-    valid_preview_tags = {}
-    
-    # 步骤1：遍历所有EXIF标签，筛选出包含二进制数据的标签
-    for full_key in raw_exif.keys():
-        tag_value = str(raw_exif.get(full_key, ""))
-        if "(Binary data" not in tag_value:
+# ========== 筛选EXIF中的二进制块 ==========
+def scan_binary_tags(raw_exif, _match=BINARY_DATA_RE.match, _str=str, _type=type, _int=int,
+                     _min_size=10240, _max_size=20 * 1024 * 1024):
+    """
+    遍历EXIF，筛选大小在 10KB ~ 20MB 之间的二进制块
+    下划线参数仅用于把热点循环中的全局名/内置名绑定为局部变量，调用时不要传入
+    :return: {标签名: (完整标签, 标签名, 大小)}（同名标签以最后出现的为准）
+    """
+    candidates = {}
+    for full_key, tag_value in raw_exif.items():
+        # 二进制占位值一定是字符串，数值等其他类型直接跳过
+        if _type(tag_value) is not _str:
             continue
-        
-        # 提取二进制块大小
-        try:
-            size_bytes = int(tag_value.split(" ")[2])
-        except (IndexError, ValueError):
+        match = _match(tag_value)
+        if not match:
             continue
         
-        # 筛选条件：10KB ~ 20MB
-        if not (10240 <= size_bytes <= 20 * 1024 * 1024):
+        # 提取二进制块大小，筛选条件：10KB ~ 20MB
+        size_bytes = _int(match.group(1))
+        if not (_min_size <= size_bytes <= _max_size):
             continue
         
         # 提取标签名和完整组名
-        tag_name = full_key.split(":")[-1] if ":" in full_key else full_key
-        
-        # 步骤2：提取二进制数据（优先JpgFromRaw）
-        is_extract_success, binary_data, used_tag = extract_preview_data(filepath, tag_name)
-        if not is_extract_success or not binary_data:
-            continue
+        tag_name = full_key.rpartition(":")[2]
+        candidates[tag_name] = (full_key, tag_name, size_bytes)
+    return candidates
+
+# ========== 核心函数：自动识别所有预览图二进制块 ==========
+def get_preview_tags(raw_exif, filepath, binary_blobs=None):
+    """
+    自动识别所有预览图二进制块
+    :param raw_exif: get_raw_exif 返回的EXIF数据
+    :param filepath: RAW文件路径
+    :param binary_blobs: 已提取的二进制数据 {标签名: 二进制数据}，缺少的标签按批次批量提取
+    :return: (按大小降序的标签名列表, 预览图元数据)，最多 MAX_PREVIEWS 个
+    """
+    valid_preview_tags = {}
+    
+    # 步骤1：遍历所有EXIF标签，筛选出包含二进制数据的标签（同名标签以最后出现的为准）
+    candidates_by_tag = scan_binary_tags(raw_exif)
+    
+    # EXIF中已给出各二进制块大小：先按大小降序排序，按需分批提取、转换，凑满 MAX_PREVIEWS 个即停止
+    ranked = sorted(candidates_by_tag.values(), key=lambda c: c[2], reverse=True)
+    binary_blobs = dict(binary_blobs or {})
+    
+    def process_one_tag(candidate):
+        full_key, tag_name, size_bytes = candidate
+        binary_data = binary_blobs.get(tag_name)
+        # 验证数据有效性（至少100字节）
+        if not binary_data or len(binary_data) <= 100:
+            return None
         
         # 转换为Web兼容格式，并复制EXIF
         is_success, converted_data, width, height, original_format = convert_image_to_web_format(
@@ -247,18 +636,38 @@ def get_preview_tags(raw_exif, filepath):
             target_format='JPEG', 
             temp_file_prefix=filepath  # 传入原始RAW路径，用于复制EXIF
         )
+        if not is_success or not converted_data:
+            return None
         
-        if is_success and converted_data:
-            valid_preview_tags[tag_name] = {
-                "full_key": full_key,       # 完整标签
-                "size_bytes": size_bytes,   # 原始大小
-                "converted_size": len(converted_data),  # 转换后大小
-                "width": width,
-                "height": height,
-                "original_format": original_format,     # 原始格式
-                "converted_format": "JPEG" if original_format not in SUPPORTED_WEB_FORMATS else original_format,
-                "used_tag": used_tag        # 实际使用的标签（JpgFromRaw/PreviewImage）
-            }
+        return tag_name, {
+            "full_key": full_key,       # 完整标签
+            "size_bytes": size_bytes,   # 原始大小
+            "converted_size": len(converted_data),  # 转换后大小
+            "width": width,
+            "height": height,
+            "original_format": original_format,     # 原始格式
+            "converted_format": "JPEG",                 # 转换后格式（目标固定为JPEG，与 /extract?format=jpeg 一致）
+            "used_tag": tag_name,       # 实际使用的标签
+            "passthrough": get_jpeg_size(binary_data) is not None,  # 是否为JPEG直通（未重新编码）
+            "converted_bytes": converted_data  # 转换后数据（供 /extract 直接返回）
+        }
+    
+    # 非图片的二进制块（如DNGPrivateData）会转换失败，此时继续处理下一批候选，直到凑满或候选耗尽
+    pos = 0
+    while len(valid_preview_tags) < MAX_PREVIEWS and pos < len(ranked):
+        batch = ranked[pos:pos + MAX_PREVIEWS - len(valid_preview_tags)]
+        pos += len(batch)
+        
+        # 步骤2：一次exiftool调用提取本批中尚未提取的二进制数据
+        missing_tags = [tag for _, tag, _ in batch if tag not in binary_blobs]
+        if missing_tags:
+            binary_blobs.update(extract_preview_blobs(filepath, missing_tags))
+        
+        # 各预览图的转换与EXIF合并互不依赖，交给线程池并行处理
+        for result in executor.map(process_one_tag, batch):
+            if result:
+                tag_name, meta = result
+                valid_preview_tags[tag_name] = meta
     
     # 步骤3：按大小降序排序
     sorted_tags = sorted(
@@ -273,24 +682,31 @@ def get_preview_tags(raw_exif, filepath):
 def get_raw_exif(filepath):
     """调用exiftool提取完整的原始EXIF数据（带截断）"""
     try:
-        cmd = ["exiftool", "-j", "-a", "-G", "-n", filepath]
-        result = subprocess.check_output(cmd, stderr=subprocess.PIPE).decode('utf-8', errors='ignore')
-        exif_data = json.loads(result)[0] if result else {}
+        result = exiftool_pool.execute("-j", "-a", "-G", "-n", filepath).decode('utf-8', errors='ignore')
+        exif_data = orjson.loads(result)[0] if result else {}
         
         # 截断过长的EXIF值
         exif_data = truncate_long_values(exif_data)
         
         return exif_data
-    except subprocess.CalledProcessError as e:
-        logging.error(f"EXIF提取失败: {e.stderr.decode('utf-8', errors='ignore')}")
+    except ExifToolError as e:
+        logging.error(f"EXIF提取失败: {e.stderr}")
         return {}
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logging.error(f"EXIF JSON解析失败: {e}")
         return {}
     except Exception as e:
         logging.error(f"EXIF解析异常: {e}")
         return {}
 
+def get_raw_exif_cached(filepath):
+    """带缓存的 get_raw_exif（/upload 与 /exif 共用）"""
+    return cached_by_file(exif_cache, filepath, lambda: get_raw_exif(filepath))
+
+def get_preview_tags_cached(raw_exif, filepath, binary_blobs=None):
+    """带缓存的 get_preview_tags"""
+    return cached_by_file(preview_cache, filepath, lambda: get_preview_tags(raw_exif, filepath, binary_blobs))
+
 # ========== 函数：解析常用EXIF字段 ==========
 def parse_exif_for_display(raw_exif, original_filename):
     """从RAW EXIF中解析常用显示字段"""
@@ -354,15 +770,22 @@ def upload_file():
             return jsonify({"error": f"不支持的格式，支持: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
         
         # 保存文件
-        file_id = str(uuid.uuid4())
+        file_id = secrets.token_hex(16)
         ext = original_filename.rsplit('.', 1)[1].lower()
         filename = secure_filename(f"{file_id}.{ext}")
         filepath = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(filepath)
+        save_upload(file, filepath)
         logging.info(f"上传文件: {filename} (原始名: {original_filename})")
         
-        # 1. 获取完整原始EXIF（带截断）
-        raw_exif = get_raw_exif(filepath)
+        @after_this_request
+        def release_upload_cache(response):
+            response.call_on_close(lambda: drop_page_cache(filepath))
+            return response
+        
+        # 1. 获取完整原始EXIF（带截断），同时并行预取常见预览图
+        exif_future = executor.submit(get_raw_exif_cached, filepath)
+        blobs_future = executor.submit(extract_preview_blobs, filepath, PREVIEW_CANDIDATE_TAGS)
+        raw_exif = exif_future.result()
         if not raw_exif:
             return jsonify({"error": "EXIF信息提取失败"}), 500
         
@@ -370,11 +793,11 @@ def upload_file():
         parsed_exif = parse_exif_for_display(raw_exif, original_filename)
         
         # 3. 自动识别所有预览图（优先JpgFromRaw）
-        preview_tags, preview_meta = get_preview_tags(raw_exif, filepath)
+        preview_tags, preview_meta = get_preview_tags_cached(raw_exif, filepath, blobs_future.result())
         
         # 4. 构建预览图详情列表
         previews = []
-        for tag in preview_tags[:5]:
+        for tag in preview_tags[:MAX_PREVIEWS]:
             meta = preview_meta[tag]
             # 格式化大小（转换后大小）
             size_bytes = meta["converted_size"]
@@ -411,13 +834,12 @@ def upload_file():
         
         previews = [p for p in previews if p['size_bytes'] > 0]
         
-        return jsonify({
+        return json_response({
             "code": 200,
             "msg": "上传成功",
             "data": {
                 "file_id": file_id,
                 "ext": ext,
-                "raw_exif": raw_exif,
                 "parsed_exif": parsed_exif,
                 "previews": previews
             }
@@ -432,40 +854,82 @@ def upload_file():
 def extract_preview(file_id, ext, tag):
     """提取预览图并转换为Web兼容格式（带原始EXIF）"""
     try:
+        if not TAG_NAME_RE.fullmatch(tag):
+            return jsonify({"code": 400, "error": "标签名不合法"}), 400
+        
         filepath = os.path.join(UPLOAD_FOLDER, f"{file_id}.{ext}")
         if not os.path.exists(filepath):
             return jsonify({"code": 404, "error": "文件已过期或不存在"}), 404
         
-        # 提取预览数据（优先JpgFromRaw）
-        is_extract_success, binary_data, used_tag = extract_preview_data(filepath, tag)
-        if not is_extract_success or not binary_data:
-            return jsonify({"code": 500, "error": "预览图提取失败"}), 500
-        
-        # 转换为Web兼容格式，并复制EXIF
-        is_success, converted_data, _, _, _ = convert_image_to_web_format(
-            binary_data, 
-            target_format='JPEG', 
-            temp_file_prefix=filepath
-        )
+        progressive = request.args.get('progressive') == '1'
+        # ?format=jpeg/webp 显式指定输出格式（如下载按钮固定为JPEG）；
+        # 未指定时按Accept协商：客户端明确支持WebP时，需要重新编码的预览图改用WebP（体积更小）
+        requested_format = request.args.get('format', '').lower()
+        if requested_format == 'jpeg':
+            accept_webp = False
+        elif requested_format == 'webp':
+            accept_webp = True
+        elif requested_format:
+            return jsonify({"code": 400, "error": "不支持的输出格式"}), 400
+        else:
+            accept_webp = 'image/webp' in request.accept_mimetypes.values()
+        output_format = 'JPEG'
         
-        if not is_success or not converted_data:
-            return jsonify({"code": 500, "error": "预览图转换失败"}), 500
+        # 优先使用上传时已转换好的预览图（缓存命中则无需exiftool/PIL）
+        # JPEG直通的预览图不重新编码，progressive/WebP 均不影响结果，始终可直接返回；
+        # 重新编码的预览图：WebP 结果在首次请求后写回缓存，基线JPEG直接复用上传时的结果
+        converted_data = None
+        cached = get_file_cache(preview_cache, filepath)
+        meta = cached[1].get(tag) if cached else None
+        if meta:
+            if meta["passthrough"]:
+                converted_data = meta["converted_bytes"]
+            elif accept_webp:
+                converted_data = meta.get("converted_bytes_webp")
+                if converted_data is not None:
+                    output_format = 'WEBP'
+            elif not progressive:
+                converted_data = meta["converted_bytes"]
         
-        # 流式返回转换后的数据
-        def generate():
-            yield converted_data
+        if converted_data is None:
+            # 提取预览数据（优先JpgFromRaw）
+            is_extract_success, binary_data, used_tag = extract_preview_data(filepath, tag)
+            if not is_extract_success or not binary_data:
+                return jsonify({"code": 500, "error": "预览图提取失败"}), 500
+            
+            # 可直通的JPEG保持原样，不重新编码为WebP
+            if accept_webp and get_jpeg_size(binary_data) is None:
+                output_format = 'WEBP'
+            
+            # 转换为Web兼容格式，并复制EXIF
+            is_success, converted_data, _, _, _ = convert_image_to_web_format(
+                binary_data, 
+                target_format=output_format, 
+                temp_file_prefix=filepath,
+                progressive=progressive
+            )
+            
+            if not is_success or not converted_data:
+                return jsonify({"code": 500, "error": "预览图转换失败"}), 500
+            
+            # WebP 结果写回预览缓存（重新写入以更新条目大小），后续请求直接返回
+            if meta and output_format == 'WEBP':
+                meta["converted_bytes_webp"] = converted_data
+                put_file_cache(preview_cache, filepath, cached)
         
         # 安全处理文件名
+        mime_type, format_ext = OUTPUT_FORMATS[output_format]
         safe_tag = tag.replace('/', '_').replace(':', '_')
-        download_name = f"{safe_tag}_{file_id[:8]}.jpg"
+        download_name = f"{safe_tag}_{file_id[:8]}.{format_ext}"
         
+        # 数据已在内存中，直接返回（Content-Length 由 Response 自动设置，无需分块传输）
         return Response(
-            generate(),
-            mimetype='image/jpeg',
+            converted_data,
+            mimetype=mime_type,
             headers={
                 "Content-Disposition": f"inline; filename={download_name}",
                 "Cache-Control": "no-cache, max-age=0",
-                "Content-Length": str(len(converted_data))
+                "Vary": "Accept"
             }
         )
     except Exception as e:
@@ -477,6 +941,9 @@ def extract_preview(file_id, ext, tag):
 def extract_preview_raw(file_id, ext, tag):
     """提取原始格式预览图（如TIFF），并复制EXIF"""
     try:
+        if not TAG_NAME_RE.fullmatch(tag):
+            return jsonify({"code": 400, "error": "标签名不合法"}), 400
+        
         filepath = os.path.join(UPLOAD_FOLDER, f"{file_id}.{ext}")
         if not os.path.exists(filepath):
             return jsonify({"code": 404, "error": "文件已过期或不存在"}), 404
@@ -492,16 +959,12 @@ def extract_preview_raw(file_id, ext, tag):
         mime_type = f"image/{original_format.lower()}" if original_format in SUPPORTED_WEB_FORMATS else "application/octet-stream"
         
         # 生成唯一临时文件（避免冲突）
-        temp_file = f"{filepath}_raw_preview_{uuid.uuid4().hex[:8]}.{format_ext}"
+        temp_file = f"{filepath}_raw_preview_{secrets.token_hex(4)}.{format_ext}"
         with open(temp_file, 'wb') as f:
             f.write(binary_data)
         
-        # 复制EXIF到原始预览文件
-        copy_exif_to_preview(filepath, temp_file)
-        
-        # 读取带EXIF的原始数据
-        with open(temp_file, 'rb') as f:
-            raw_data_with_exif = f.read()
+        # 复制EXIF到原始预览数据（复制失败则返回原始数据）
+        raw_data_with_exif = copy_exif_to_preview(filepath, temp_file) or binary_data
         
         # 清理临时文件
         if os.path.exists(temp_file):
@@ -511,21 +974,17 @@ def extract_preview_raw(file_id, ext, tag):
             except Exception as e:
                 logging.warning(f"清理原始预览临时文件失败: {e}")
         
-        # 流式返回数据
-        def generate():
-            yield raw_data_with_exif
-        
         # 安全处理文件名
         safe_tag = tag.replace('/', '_').replace(':', '_')
         download_name = f"{safe_tag}_{file_id[:8]}.{format_ext}"
         
+        # 数据已在内存中，直接返回（Content-Length 由 Response 自动设置，无需分块传输）
         return Response(
-            generate(),
+            raw_data_with_exif,
             mimetype=mime_type,
             headers={
                 "Content-Disposition": f"attachment; filename={download_name}",
-                "Cache-Control": "no-cache, max-age=0",
-                "Content-Length": str(len(raw_data_with_exif))
+                "Cache-Control": "no-cache, max-age=0"
             }
         )
     except Exception as e:
@@ -548,13 +1007,13 @@ def index():
 
 @app.route('/exif/<file_id>/<ext>')
 def get_exif(file_id, ext):
-    """获取原始EXIF（调试用，带截断）"""
+    """获取原始EXIF（前端按需获取，带截断）"""
     try:
         filepath = os.path.join(UPLOAD_FOLDER, f"{file_id}.{ext}")
         if not os.path.exists(filepath):
             return jsonify({"code": 404, "error": "文件不存在"}), 404
-        raw_exif = get_raw_exif(filepath)
-        return jsonify({"code": 200, "data": raw_exif})
+        raw_exif = get_raw_exif_cached(filepath)
+        return json_response({"code": 200, "data": raw_exif})
     except Exception as e:
         return jsonify({"code": 500, "error": str(e)}), 500
 
@@ -563,4 +1022,6 @@ if __name__ == '__main__':
     try:
         app.run(host='0.0.0.0', port=10099, debug=False, threaded=True)
     finally:
-        scheduler.shutdown()
\ No newline at end of file
+        cleanup_stop.set()
+        executor.shutdown(wait=False)
+        exiftool_pool.close()
\ No newline at end of file